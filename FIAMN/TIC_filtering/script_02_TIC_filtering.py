@@ -1,3 +1,47 @@
+import numpy as np
+
+
+def _total_peak_intensity(block):
+    """
+    Sums the intensity column of the peak lines in a single spectrum block.
+
+    Args:
+        block (bytes): Content between 'BEGIN IONS' and 'END IONS'.
+
+    Returns:
+        float: Total ion intensity of the block.
+    """
+    # Peak lines follow the last metadata line (e.g. PEPMASS=, RTINSECONDS=)
+    last_meta = block.rfind(b'=')
+    peak_start = 0 if last_meta == -1 else block.find(b'\n', last_meta) + 1
+    peak_region = block[peak_start:].strip()
+    if not peak_region:
+        return 0.0
+
+    # Parse the whole peak region in one call instead of one float() per peak; it is only
+    # trusted when every line has as many columns as the first (blank lines fall back too)
+    n_cols = len(peak_region.split(b'\n', 1)[0].split())
+    n_lines = peak_region.count(b'\n') + 1
+    try:
+        values = np.fromstring(peak_region, sep=' ')
+    except ValueError:
+        # Recent NumPy raises on text it cannot parse; older versions warn and stop early
+        values = None
+    if values is not None and n_cols >= 2 and values.size == n_cols * n_lines:
+        return float(values.reshape(-1, n_cols)[:, 1].sum())
+
+    # Fallback for irregular peak lines (mixed column counts, stray text)
+    total_intensity = 0.0
+    for line in peak_region.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            try:
+                total_intensity += float(parts[1])
+            except ValueError:
+                continue
+    return total_intensity
+
+
 def filter_mgf_by_total_intensity(input_file, output_file, min_total_intensity=2000):
     """
     Filters spectra in an MGF file whose total ion intensity is below a specified threshold.
@@ -7,51 +51,24 @@ def filter_mgf_by_total_intensity(input_file, output_file, min_total_intensity=2
         output_file (str): Path to the output MGF file.
         min_total_intensity (float): Minimum total ion intensity threshold, default is 2000.
     """
-    # Initialize variables
-    current_spectrum = []  # Stores all lines of the current spectrum
-    in_spectrum = False    # Flag to indicate if currently reading spectrum content
-    total_intensity = 0.0  # Total ion intensity of the current spectrum
-
     try:
-        with open(input_file, 'r', encoding='utf-8') as infile, \
-                open(output_file, 'w', encoding='utf-8') as outfile:
-
-            # Process the file line by line
-            for line in infile:
-                stripped_line = line.strip()
-
-                # Start processing the spectrum when 'BEGIN IONS' is encountered
-                if stripped_line == 'BEGIN IONS':
-                    in_spectrum = True
-                    current_spectrum = [line]
-                    total_intensity = 0.0
-                    continue
-
-                # End processing, calculate total intensity, and decide whether to save
-                elif stripped_line == 'END IONS':
-                    in_spectrum = False
-                    current_spectrum.append(line)
-
-                    # Write to file only if total ion intensity meets the threshold
-                    if total_intensity >= min_total_intensity:
-                        outfile.writelines(current_spectrum)
+        with open(input_file, 'rb') as infile, \
+                open(output_file, 'wb') as outfile:
 
+            # Split the whole file into spectrum blocks at once
+            for chunk in infile.read().split(b'BEGIN IONS')[1:]:
+                end = chunk.find(b'END IONS')
+                if end == -1:
+                    # Unterminated spectrum (truncated file)
                     continue
 
-                # Handle content inside the spectrum block
-                if in_spectrum:
-                    current_spectrum.append(line)
-
-                    # Parse peak data (Format: m/z intensity [additional info])
-                    parts = stripped_line.split()
-                    if len(parts) >= 2:
-                        try:
-                            # The second column is typically the intensity
-                            intensity = float(parts[1])
-                            total_intensity += intensity
-                        except ValueError:
-                            # Skip non-numeric lines (e.g., metadata/header lines like TITLE=)
-                            continue
+                # Keep the block through the end of the 'END IONS' line
+                line_end = chunk.find(b'\n', end)
+                block_end = len(chunk) if line_end == -1 else line_end + 1
+
+                # Write the block verbatim only if total ion intensity meets the threshold
+                if _total_peak_intensity(chunk[:end]) >= min_total_intensity:
+                    outfile.write(b'BEGIN IONS' + chunk[:block_end])
 
             print(f"Processing complete!")
             print(f"Input file: {input_file}")
@@ -66,6 +83,35 @@ def filter_mgf_by_total_intensity(input_file, output_file, min_total_intensity=2
         print(f"An error occurred during processing: {str(e)}")
 
 
+def filter_npz_by_total_intensity(input_file, output_file, min_total_intensity=2000):
+    """
+    Same filter as filter_mgf_by_total_intensity, on the binary stage cache (.npz).
+
+    Args:
+        input_file (str): Path to the input .npz file.
+        output_file (str): Path to the output .npz file.
+        min_total_intensity (float): Minimum total ion intensity threshold, default is 2000.
+    """
+    # Imported here so this script still runs standalone from its own directory
+    from mgf_binary_cache.mgf_binary import load_mgf_npz, save_mgf_npz, take_rows
+
+    mz_concat, int_concat, indptr, meta_list = load_mgf_npz(input_file)
+
+    # Per-spectrum totals in one call; empty spectra keep a total of 0
+    total_intensity = np.zeros(len(meta_list))
+    non_empty = np.diff(indptr) > 0
+    if non_empty.any():
+        total_intensity[non_empty] = np.add.reduceat(int_concat, indptr[:-1][non_empty])
+
+    rows = np.flatnonzero(total_intensity >= min_total_intensity)
+    save_mgf_npz(output_file, *take_rows(mz_concat, int_concat, indptr, rows), [meta_list[k] for k in rows])
+
+    print(f"Processing complete!")
+    print(f"Input file: {input_file}")
+    print(f"Output file: {output_file}")
+    print(f"Filtering threshold: Total Ion Intensity >= {min_total_intensity}")
+
+
 # Example usage
 if __name__ == "__main__":
     # Update these paths to your actual file locations
@@ -1,68 +1,90 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from numba import njit
 from tqdm import tqdm
 
 # Note: These modules must exist in your local environment
 from finger_id.g_config import config, update_config_on_main
 from finger_id.mgf import get_mgf, write_mgf
-from finger_id.mgf_similarity import id_of_spectrum, copy_of_spectrum, np_array_of_spectrum
+from finger_id.mgf_similarity import id_of_spectrum, np_array_of_spectrum
+
+
+@njit
+def _find_plateaus(intensity_derivative, eps=1e-6):
+    """
+    Returns the start and end indices of the near-zero (plateau) runs in the derivative.
+    """
+    n = len(intensity_derivative)
+    plateau_start_indices = np.empty(n, np.int64)
+    plateau_end_indices = np.empty(n, np.int64)
+    n_start = 0
+    n_end = 0
+
+    for i in range(1, n - 1):
+        if abs(intensity_derivative[i]) < eps:
+            # Start of a plateau
+            if abs(intensity_derivative[i - 1]) > eps:
+                plateau_start_indices[n_start] = i
+                n_start += 1
+            # End of a plateau
+            if abs(intensity_derivative[i + 1]) > eps:
+                plateau_end_indices[n_end] = i
+                n_end += 1
+
+    return plateau_start_indices[:n_start], plateau_end_indices[:n_end]
+
 
+@njit
+def _longest_plateau_end(plateau_start_indices, plateau_end_indices):
+    """
+    Returns the end index of the longest plateau, or -1 if no valid plateau exists.
+    """
+    if len(plateau_start_indices) == 0 or len(plateau_end_indices) == 0:
+        return -1
+
+    # Align start and end indices to ensure valid pairs
+    if plateau_start_indices[0] > plateau_end_indices[0]:
+        plateau_end_indices = plateau_end_indices[1:]
+    n_pairs = min(len(plateau_start_indices), len(plateau_end_indices))
+    if n_pairs == 0:
+        return -1
+
+    plateau_lengths = plateau_end_indices[:n_pairs] - plateau_start_indices[:n_pairs]
+    return plateau_end_indices[np.argmax(plateau_lengths)]
 
-def adaptive_plateau_denoising(spectrum):
+
+def adaptive_plateau_denoising(spectrum, verbose=False):
     """
     Performs adaptive denoising based on the longest plateau in the sorted intensity derivative.
+    Per-spectrum peak statistics are printed only when verbose is set.
     """
-    spectrum = copy_of_spectrum(spectrum)
-    mz_ori = spectrum['mz_array']
-    intensity_ori = spectrum['intensity_array']
+    # Shallow copy: only top-level keys are reassigned below, the input arrays are never modified in place
+    spectrum = dict(spectrum)
+    intensity_ori = np.asarray(spectrum['intensity_array'])
 
-    # Pair m/z and intensity, filter out zero-intensity peaks
-    mz_itst = list(zip(mz_ori, intensity_ori))
-    mz_itst = list(filter(lambda mi: mi[1] > 0, mz_itst))
-    
-    # Sort peaks by intensity in ascending order
-    mz_itst.sort(key=lambda mi: mi[1])
-    print('Peak Count:', 'Original:', len(intensity_ori), 'Non-zero:', len(mz_itst))
-    
-    intensities = np.array([mi[1] for mi in mz_itst])
+    # Filter out zero-intensity peaks and sort the rest by intensity in ascending order
+    nonzero_idx = np.flatnonzero(intensity_ori > 0)
+    intensities = np.sort(intensity_ori[nonzero_idx])
+    if verbose:
+        print('Peak Count:', 'Original:', len(intensity_ori), 'Non-zero:', len(nonzero_idx))
 
     # Calculate the first derivative (difference between adjacent sorted intensities)
-    shifted_intensities = np.concatenate(((intensities[0],), intensities))[:-1]
-    intensity_derivative = intensities - shifted_intensities
-    
-    print('Derivative non-zero count:', len([val for val in intensity_derivative if val > 0]))
+    intensity_derivative = np.diff(intensities, prepend=intensities[0])
 
-    # Identify indices where the derivative is near zero (the plateau/flat regions)
-    plateau_start_indices = []
-    plateau_end_indices = []
-    
-    for i in range(1, len(intensity_derivative) - 1):
-        if abs(intensity_derivative[i]) < 1e-6:
-            # Start of a plateau
-            if abs(intensity_derivative[i-1]) > 1e-6:
-                plateau_start_indices.append(i)
-            # End of a plateau
-            if abs(intensity_derivative[i+1]) > 1e-6:
-                plateau_end_indices.append(i)
+    if verbose:
+        print('Derivative non-zero count:', int((intensity_derivative > 0).sum()))
 
-    plateau_start_indices = np.array(plateau_start_indices)
-    plateau_end_indices = np.array(plateau_end_indices)
+    # Identify indices where the derivative is near zero (the plateau/flat regions)
+    plateau_start_indices, plateau_end_indices = _find_plateaus(intensity_derivative)
 
-    # Align start and end indices to ensure valid pairs
-    if len(plateau_start_indices) > 0 and len(plateau_end_indices) > 0:
-        if plateau_start_indices[0] > plateau_end_indices[0]:
-            plateau_end_indices = plateau_end_indices[1:]
-            plateau_start_indices = plateau_start_indices[0:len(plateau_end_indices)]
-        
-        plateau_lengths = plateau_end_indices - plateau_start_indices
-    else:
+    # Find the longest plateau (the region with the most stable noise)
+    end_idx_of_longest_plateau = _longest_plateau_end(plateau_start_indices, plateau_end_indices)
+    if end_idx_of_longest_plateau < 0:
         # Fallback if no plateau is found
         return 0, spectrum
 
-    # Find the longest plateau (the region with the most stable noise)
-    longest_plateau_idx = np.argmax(plateau_lengths)
-    end_idx_of_longest_plateau = plateau_end_indices[longest_plateau_idx]
-    
     # The threshold is defined as the intensity at the end of the longest plateau
     dynamic_threshold = intensities[end_idx_of_longest_plateau]
 
@@ -82,7 +104,10 @@ def adaptive_plateau_denoising(spectrum):
     return dynamic_threshold, spectrum
 
 
-def process_mgf_file(mgf_fpath):
+def process_mgf_file(mgf_fpath, verbose=False):
+    """
+    Denoises every spectrum of an MGF file and writes them to a single output MGF.
+    """
     print('Processing file:', mgf_fpath)
     spectrums = get_mgf(mgf_fpath, use_index=config['use_index'], show_progress=True, count=None)
     print('Total spectra in file:', len(spectrums))
@@ -90,30 +115,36 @@ def process_mgf_file(mgf_fpath):
     result_dir = config['mgf_result_dpath']
     base_name = os.path.basename(mgf_fpath)
     
+    output_path = os.path.join(result_dir, f'{os.path.splitext(base_name)[0]}_denoised.mgf')
+
     spectrums_filtered = []
-    
-    for i in tqdm(range(len(spectrums))):
-        spec = spectrums[i]
-        spec_id = id_of_spectrum(spec)
-        print(f'Index {i} | Spectrum ID: {spec_id} | Original Peaks: {len(spec["intensity_array"])}')
-
-        # Apply adaptive denoising
-        threshold, denoised_spec = adaptive_plateau_denoising(spec)
-        print(f'Denoised | Dynamic Threshold: {threshold:.4f}')
-
-        # Save individual denoised spectrum
-        output_path = os.path.join(result_dir, f'{base_name}_denoised_{spec_id}.mgf')
-        with open(output_path, 'w') as f_out:
+
+    # One handle for the whole file instead of an open/close per spectrum
+    with open(output_path, 'w') as f_out:
+        for i in tqdm(range(len(spectrums))):
+            spec = spectrums[i]
+            if verbose:
+                spec_id = id_of_spectrum(spec)
+                print(f'Index {i} | Spectrum ID: {spec_id} | Original Peaks: {len(spec["intensity_array"])}')
+
+            # Apply adaptive denoising
+            threshold, denoised_spec = adaptive_plateau_denoising(spec, verbose=verbose)
+            if verbose:
+                print(f'Denoised | Dynamic Threshold: {threshold:.4f}')
+
+            # Append the denoised spectrum to the shared output file
             write_mgf(f_out, denoised_spec)
 
-        spectrums_filtered.append(spec)
-    
+            spectrums_filtered.append(spec)
+
+    print(f'Saved denoised spectra to: {output_path}')
     print(f'Completed processing: {len(spectrums_filtered)} spectra.')
 
 
-def main():
+def main(max_workers=None):
     """
     Main entry point for adaptive MS2 denoising.
+    MGF files are independent, so each one is processed in its own worker process.
     """
     print('Starting Adaptive Denoising Workflow...')
     mgf_dir = config['mgf_dpath']
@@ -121,8 +152,10 @@ def main():
     # Locate all MGF files in the target directory
     mgf_files = [os.path.join(mgf_dir, f) for f in os.listdir(mgf_dir) if f.endswith('.mgf')]
     
-    for file_path in mgf_files:
-        process_mgf_file(file_path)
+    # Workers re-apply the current configuration, since spawned processes start from the defaults
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=update_config_on_main,
+                             initargs=(dict(config),)) as executor:
+        list(executor.map(process_mgf_file, mgf_files))
 
 
 if __name__ == '__main__':
@@ -1,27 +1,198 @@
+from collections import deque
+
 import numpy as np
+from numba import njit, prange
 from matchms.importing import load_from_mgf
 from matchms.similarity import CosineGreedy
-from matchms.filtering import normalize_intensities
 from matchms import Spectrum
 
 
 # --- Internal Helper Functions ---
-def merge_peaks_internal(spectrum: Spectrum, tolerance=0.02) -> Spectrum:
+def pack_peaks_csr(spectrums):
+    """
+    Packs the peaks of all spectrums into CSR-style flat arrays (mz, intensities, row pointers).
+    """
+    indptr = np.zeros(len(spectrums) + 1, dtype=np.int64)
+    np.cumsum([len(s.peaks) for s in spectrums], out=indptr[1:])
+    data_mz = np.concatenate([s.peaks.mz for s in spectrums] + [np.empty(0)]).astype(np.float64)
+    data_int = np.concatenate([s.peaks.intensities for s in spectrums] + [np.empty(0)]).astype(np.float64)
+    return data_mz, data_int, indptr
+
+
+@njit
+def merge_peaks_csr(data_mz, data_int, indptr, tolerance=0.02):
+    """
+    Merges peaks within a certain m/z tolerance, keeping the highest intensity peak, for every
+    CSR row in one pass, followed by normalization to unit height. Rows must be sorted by m/z
+    (as matchms guarantees).
+    """
+    out_mz = np.empty_like(data_mz)
+    out_int = np.empty_like(data_int)
+    out_indptr = np.zeros_like(indptr)
+    n_out = 0
+
+    for row in range(len(indptr) - 1):
+        mz = data_mz[indptr[row]:indptr[row + 1]]
+        intensities = data_int[indptr[row]:indptr[row + 1]]
+        n = len(mz)
+        keep = np.zeros(n, dtype=np.bool_)
+
+        # Keep peaks in descending intensity order unless a kept neighbour is within tolerance
+        for i in np.argsort(intensities, kind='mergesort')[::-1]:
+            free = True
+            j = i - 1
+            while free and j >= 0 and mz[i] - mz[j] <= tolerance:
+                free = not keep[j]
+                j -= 1
+            j = i + 1
+            while free and j < n and mz[j] - mz[i] <= tolerance:
+                free = not keep[j]
+                j += 1
+            keep[i] = free
+
+        # Normalize to unit height; rows without positive intensity end up empty
+        max_intensity = intensities.max() if n > 0 else 0.0
+        if max_intensity > 0:
+            for i in range(n):
+                if keep[i]:
+                    out_mz[n_out] = mz[i]
+                    out_int[n_out] = intensities[i] / max_intensity
+                    n_out += 1
+        out_indptr[row + 1] = n_out
+
+    return out_mz[:n_out], out_int[:n_out], out_indptr
+
+
+def quantize_intensities(intensities):
+    """
+    Maps unit-height normalized intensities onto 8-bit integers (0-255).
+    """
+    return np.round(np.clip(intensities, 0.0, 1.0) * 255.0).astype(np.uint8)
+
+
+@njit
+def _greedy_cosine_quantized(mz_a, q_a, mz_b, q_b, tolerance):
+    """
+    CosineGreedy-style score between two m/z-sorted peak lists with 8-bit intensities.
+    """
+    n_a, n_b = len(mz_a), len(mz_b)
+
+    # Count candidate peak pairs within tolerance (both lists are sorted by m/z)
+    n_pairs = 0
+    lo = 0
+    for i in range(n_a):
+        while lo < n_b and mz_a[i] - mz_b[lo] > tolerance:
+            lo += 1
+        j = lo
+        while j < n_b and mz_b[j] - mz_a[i] <= tolerance:
+            n_pairs += 1
+            j += 1
+    if n_pairs == 0:
+        return 0.0
+
+    pair_a = np.empty(n_pairs, dtype=np.int64)
+    pair_b = np.empty(n_pairs, dtype=np.int64)
+    products = np.empty(n_pairs, dtype=np.int64)
+    k = 0
+    lo = 0
+    for i in range(n_a):
+        while lo < n_b and mz_a[i] - mz_b[lo] > tolerance:
+            lo += 1
+        j = lo
+        while j < n_b and mz_b[j] - mz_a[i] <= tolerance:
+            pair_a[k] = i
+            pair_b[k] = j
+            products[k] = np.int64(q_a[i]) * np.int64(q_b[j])
+            k += 1
+            j += 1
+
+    # Greedily take the highest products, each peak used at most once
+    used_a = np.zeros(n_a, dtype=np.bool_)
+    used_b = np.zeros(n_b, dtype=np.bool_)
+    dot = np.int64(0)
+    for k in np.argsort(-products, kind='mergesort'):
+        if not used_a[pair_a[k]] and not used_b[pair_b[k]]:
+            dot += products[k]
+            used_a[pair_a[k]] = True
+            used_b[pair_b[k]] = True
+
+    norm_a = np.int64(0)
+    for i in range(n_a):
+        norm_a += np.int64(q_a[i]) * np.int64(q_a[i])
+    norm_b = np.int64(0)
+    for j in range(n_b):
+        norm_b += np.int64(q_b[j]) * np.int64(q_b[j])
+    if norm_a == 0 or norm_b == 0:
+        return 0.0
+    return dot / np.sqrt(np.float64(norm_a) * np.float64(norm_b))
+
+
+@njit(parallel=True)
+def quantized_cosine_matrix(data_mz, data_q, indptr, tolerance=0.02):
     """
-    Merges peaks within a certain m/z tolerance, keeping the highest intensity peak.
+    All-vs-all greedy cosine scores over CSR rows with 8-bit intensities (float32 matrix).
     """
-    if spectrum is None: return None
-    mz, intensities = spectrum.peaks.mz, spectrum.peaks.intensities
-    # Sort indices by intensity in descending order
-    idx_sorted = np.argsort(intensities)[::-1]
-    keep_idx, seen_mz = [], []
-    for i in idx_sorted:
-        # Check if the current peak is within tolerance of already kept peaks
-        if not any(abs(mz[i] - ref) <= tolerance for ref in seen_mz):
-            keep_idx.append(i)
-            seen_mz.append(mz[i])
-    keep_idx.sort()
-    return Spectrum(mz=mz[keep_idx], intensities=intensities[keep_idx], metadata=spectrum.metadata.copy())
+    n = len(indptr) - 1
+    scores = np.zeros((n, n), dtype=np.float32)
+    for i in prange(n):
+        for j in range(i + 1, n):
+            score = _greedy_cosine_quantized(
+                data_mz[indptr[i]:indptr[i + 1]], data_q[indptr[i]:indptr[i + 1]],
+                data_mz[indptr[j]:indptr[j + 1]], data_q[indptr[j]:indptr[j + 1]],
+                tolerance,
+            )
+            scores[i, j] = score
+            scores[j, i] = score
+    return scores
+
+
+@njit(parallel=True)
+def quantized_cosine_pairs(data_mz, data_q, indptr, idx_row, idx_col, tolerance=0.02):
+    """
+    Greedy cosine scores with 8-bit intensities for the listed (row, col) CSR pairs only.
+    """
+    scores = np.zeros(len(idx_row), dtype=np.float32)
+    for k in prange(len(idx_row)):
+        i, j = idx_row[k], idx_col[k]
+        scores[k] = _greedy_cosine_quantized(
+            data_mz[indptr[i]:indptr[i + 1]], data_q[indptr[i]:indptr[i + 1]],
+            data_mz[indptr[j]:indptr[j + 1]], data_q[indptr[j]:indptr[j + 1]],
+            tolerance,
+        )
+    return scores
+
+
+@njit(parallel=True)
+def quantized_cosine_row(data_mz, data_q, indptr, row, cols, tolerance=0.02):
+    """
+    Greedy cosine scores with 8-bit intensities of one CSR row against the listed CSR rows.
+    """
+    scores = np.zeros(len(cols), dtype=np.float32)
+    for k in prange(len(cols)):
+        j = cols[k]
+        scores[k] = _greedy_cosine_quantized(
+            data_mz[indptr[row]:indptr[row + 1]], data_q[indptr[row]:indptr[row + 1]],
+            data_mz[indptr[j]:indptr[j + 1]], data_q[indptr[j]:indptr[j + 1]],
+            tolerance,
+        )
+    return scores
+
+
+def precursor_window_pairs(precursor_mzs, window):
+    """
+    Returns (idx_row, idx_col) for every spectrum pair whose precursor m/z differ by at most
+    window Da. Spectra without a precursor m/z are never paired.
+    """
+    pm = np.asarray(precursor_mzs, dtype=np.float64)
+    finite = np.flatnonzero(np.isfinite(pm))
+    order = finite[np.argsort(pm[finite], kind='mergesort')]
+    sorted_pm = pm[order]
+
+    # In precursor order, each spectrum pairs with the following ones up to its m/z + window
+    counts = np.searchsorted(sorted_pm, sorted_pm + window, side='right') - np.arange(len(order)) - 1
+    first = np.repeat(np.arange(len(order)), counts)
+    second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return order[first], order[second]
 
 
 def save_as_pepmass_rt_mgf(spectrums, output_file):
@@ -45,55 +216,200 @@ def save_as_pepmass_rt_mgf(spectrums, output_file):
 
 
 # --- Improved Search Logic Function ---
-def run_final_restoration_v2(input_path, output_path, target_mz, target_rt, threshold=0.7):
+def find_seed_index(spectrum_info, target_mz, target_rt):
+    """
+    Returns the index of the first spectrum matching the target MZ/RT, or None.
+    :param spectrum_info: Sequence of (precursor_mz, retention_time, title) per spectrum
+    """
+    print(f"🔍 Searching for target: m/z={target_mz}, RT={target_rt}...")
+
+    for i, (curr_mz, curr_rt, title) in enumerate(spectrum_info):
+        if curr_mz and curr_rt:
+            # Set a small error tolerance for matching
+            if abs(curr_mz - target_mz) < 0.005 and abs(curr_rt - target_rt) < 2.0:
+                print(f"✅ Seed spectrum found! Title: {title[:50]}...")
+                return i
+
+    print("❌ Could not find spectrum via m/z and RT. Please check your parameters.")
+    return None
+
+
+def expand_family(merged_mz, merged_int, merged_indptr, seed_idx, threshold=0.7, quantized=False,
+                  precursor_mzs=None, precursor_window=None, full_matrix=False):
+    """
+    Breadth-first search over the thresholded similarity graph of merged, normalized
+    CSR spectra. Returns the set of spectrum indices connected to the seed.
+    With precursor_window (Da) set, only pairs whose precursor_mzs lie within the window
+    are scored; all other pairs count as unconnected.
+    By default only the spectra the search reaches are scored against the rest, which
+    costs O(family size x N) pairs. full_matrix=True scores every pair up front instead.
+    """
+    print(f"🚀 Searching for similar spectra (threshold: {threshold})...")
+    n = len(merged_indptr) - 1
+    if quantized:
+        merged_q = quantize_intensities(merged_int)
+    else:
+        # Scoring only needs the peaks, so skip metadata handling here
+        spectrums = [
+            Spectrum(mz=merged_mz[lo:hi], intensities=merged_int[lo:hi], metadata_harmonization=False)
+            for lo, hi in zip(merged_indptr[:-1], merged_indptr[1:])
+        ]
+        cosine_sim = CosineGreedy(tolerance=0.02)
+
+    if full_matrix:
+        neighbors = _score_all_pairs(merged_mz, merged_indptr, threshold, quantized,
+                                     merged_q if quantized else spectrums, precursor_mzs, precursor_window)
+    elif precursor_window is not None:
+        precursor_mzs = np.asarray(precursor_mzs, dtype=np.float64)
+
+    # Breadth-first search for connected similarity network. Without a full matrix each
+    # dequeued spectrum is scored once against the spectra not selected yet; a pair whose
+    # partner is already selected cannot extend the family, so no pair is ever rescored
+    unselected = np.ones(n, dtype=bool)
+    unselected[seed_idx] = False
+    selected_indices, to_explore = {seed_idx}, deque([seed_idx])
+    while to_explore:
+        curr = to_explore.popleft()
+        if full_matrix:
+            linked = [i for i in neighbors[curr] if unselected[i]]
+        else:
+            candidates = unselected
+            if precursor_window is not None:
+                # Missing precursors are NaN and compare False, so they are never paired
+                candidates = unselected & (np.abs(precursor_mzs - precursor_mzs[curr]) <= precursor_window)
+            candidates = np.flatnonzero(candidates)
+            if len(candidates) == 0: continue
+            if quantized:
+                scores = quantized_cosine_row(merged_mz, merged_q, merged_indptr, curr, candidates, 0.02)
+            else:
+                scores = cosine_sim.matrix([spectrums[curr]], [spectrums[k] for k in candidates],
+                                           progress_bar=False)['score'][0]
+            linked = candidates[scores >= threshold].tolist()
+        for i in linked:
+            selected_indices.add(i)
+            unselected[i] = False
+            to_explore.append(i)
+    return selected_indices
+
+
+def _score_all_pairs(merged_mz, merged_indptr, threshold, quantized, peaks, precursor_mzs, precursor_window):
+    """
+    Scores every spectrum pair exactly once (optionally only pairs within the precursor
+    window) and returns the thresholded adjacency lists. peaks holds the 8-bit intensities
+    when quantized, otherwise the matchms spectra.
+    """
+    if precursor_window is not None:
+        idx_row, idx_col = precursor_window_pairs(precursor_mzs, precursor_window)
+        print(f"   Scoring {len(idx_row)} pairs within ±{precursor_window} Da precursor m/z")
+
+    if quantized:
+        if precursor_window is None:
+            scores = quantized_cosine_matrix(merged_mz, peaks, merged_indptr, 0.02)
+        else:
+            scores = quantized_cosine_pairs(merged_mz, peaks, merged_indptr, idx_row, idx_col, 0.02)
+    else:
+        if precursor_window is None:
+            scores = CosineGreedy(tolerance=0.02).matrix(peaks, peaks, is_symmetric=True, progress_bar=False)['score']
+        else:
+            scores = CosineGreedy(tolerance=0.02).sparse_array(peaks, peaks, idx_row, idx_col)['score']
+
+    if precursor_window is None:
+        return [np.flatnonzero(row >= threshold).tolist() for row in scores]
+    neighbors = [[] for _ in range(len(merged_indptr) - 1)]
+    linked = scores >= threshold
+    for i, j in zip(idx_row[linked].tolist(), idx_col[linked].tolist()):
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    return neighbors
+
+
+def run_final_restoration_v2(input_path, output_path, target_mz, target_rt, threshold=0.7, quantized=False,
+                             precursor_window=None, full_matrix=False):
     """
     Finds a seed spectrum by MZ/RT and performs a network-based similarity search
     to extract related spectra.
+    With quantized=True the threshold decision uses 8-bit intensities; the exported
+    spectra always keep full-precision intensities.
+    With precursor_window (Da) set, only spectra whose precursor m/z lie within the window
+    of each other are compared (e.g. 200 for diterpenoid families).
+    With full_matrix=True every spectrum pair is scored before the search (see expand_family).
     """
     print(f"--- Loading MGF file ---")
     # Enable metadata_harmonization to ensure standard access to mz/rt
     raw_spectrums = list(load_from_mgf(input_path, metadata_harmonization=True))
 
     # 1. Search for Seed Index using MZ and RT
-    seed_idx = None
-    print(f"🔍 Searching for target: m/z={target_mz}, RT={target_rt}...")
-
-    for i, s in enumerate(raw_spectrums):
-        curr_mz = s.get("precursor_mz")
-        curr_rt = s.get("retention_time")
-        if curr_mz and curr_rt:
-            # Set a small error tolerance for matching
-            if abs(curr_mz - target_mz) < 0.005 and abs(curr_rt - target_rt) < 2.0:
-                seed_idx = i
-                print(f"✅ Seed spectrum found! Title: {s.get('title')[:50]}...")
-                break
-
+    precursor_mzs = [s.get("precursor_mz") for s in raw_spectrums]
+    seed_idx = find_seed_index(
+        [(mz, s.get("retention_time"), s.get("title")) for mz, s in zip(precursor_mzs, raw_spectrums)],
+        target_mz, target_rt)
     if seed_idx is None:
-        print("❌ Could not find spectrum via m/z and RT. Please check your parameters.")
         return
 
     # 2. Pre-processing and Clustering
-    processed_spectrums = [normalize_intensities(merge_peaks_internal(s)) for s in raw_spectrums]
-    cosine_sim = CosineGreedy(tolerance=0.02)
-    selected_indices, to_explore = {seed_idx}, [seed_idx]
-
-    print(f"🚀 Searching for similar spectra (threshold: {threshold})...")
-    # Breadth-first search for connected similarity network
-    while to_explore:
-        curr = to_explore.pop(0)
-        for i, other in enumerate(processed_spectrums):
-            if i in selected_indices: continue
-            score = cosine_sim.pair(processed_spectrums[curr], other)['score']
-            if score >= threshold:
-                selected_indices.add(i)
-                to_explore.append(i)
+    # Merge and normalize all spectra in one compiled pass over flat peak arrays
+    merged_mz, merged_int, merged_indptr = merge_peaks_csr(*pack_peaks_csr(raw_spectrums))
+    selected_indices = expand_family(merged_mz, merged_int, merged_indptr, seed_idx, threshold, quantized,
+                                     precursor_mzs, precursor_window, full_matrix)
 
     # 3. Save Results
-    final_specs = [processed_spectrums[i] for i in selected_indices]
+    final_specs = [
+        Spectrum(mz=merged_mz[merged_indptr[i]:merged_indptr[i + 1]],
+                 intensities=merged_int[merged_indptr[i]:merged_indptr[i + 1]],
+                 metadata=raw_spectrums[i].metadata.copy())
+        for i in selected_indices
+    ]
     save_as_pepmass_rt_mgf(final_specs, output_path)
     print(f"✨ Done! Found {len(final_specs)} related spectra.")
 
 
+def _header_float(value):
+    """Parses the leading number of an MGF header value (e.g. 'PEPMASS=289.25 1000')."""
+    try:
+        return float(value.split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def run_final_restoration_v2_npz(input_path, output_path, target_mz, target_rt, threshold=0.7, quantized=False,
+                                 precursor_window=None, full_matrix=False):
+    """
+    Same search as run_final_restoration_v2, reading and writing the binary stage cache (.npz).
+    """
+    # Imported here so this script still runs standalone from its own directory
+    from mgf_binary_cache.mgf_binary import load_mgf_npz, save_mgf_npz, take_rows
+
+    print(f"--- Loading binary stage cache ---")
+    mz_concat, int_concat, indptr, meta_list = load_mgf_npz(input_path)
+    precursor_mzs = [_header_float(meta.get('PEPMASS')) for meta in meta_list]
+    retention_times = [_header_float(meta.get('RTINSECONDS')) for meta in meta_list]
+
+    # 1. Search for Seed Index using MZ and RT
+    seed_idx = find_seed_index(
+        [(mz, rt, meta.get('TITLE', '')) for mz, rt, meta in zip(precursor_mzs, retention_times, meta_list)],
+        target_mz, target_rt)
+    if seed_idx is None:
+        return
+
+    # 2. Pre-processing and Clustering (rows sorted by m/z, as matchms does on import)
+    row_ids = np.repeat(np.arange(len(meta_list)), np.diff(indptr))
+    order = np.lexsort((mz_concat, row_ids))
+    merged_mz, merged_int, merged_indptr = merge_peaks_csr(mz_concat[order], int_concat[order], indptr)
+    selected_indices = expand_family(merged_mz, merged_int, merged_indptr, seed_idx, threshold, quantized,
+                                     precursor_mzs, precursor_window, full_matrix)
+
+    # 3. Save Results (same header fields as save_as_pepmass_rt_mgf)
+    rows = list(selected_indices)
+    final_meta = []
+    for i in rows:
+        meta = {'TITLE': meta_list[i].get('TITLE', '')}
+        if retention_times[i] is not None: meta['RTINSECONDS'] = str(retention_times[i])
+        if precursor_mzs[i] is not None: meta['PEPMASS'] = str(precursor_mzs[i])
+        final_meta.append(meta)
+    save_mgf_npz(output_path, *take_rows(merged_mz, merged_int, merged_indptr, rows), final_meta)
+    print(f"✨ Done! Found {len(rows)} related spectra.")
+
+
 if __name__ == "__main__":
     # --- User Configuration ---
     # Based on your provided info:
@@ -0,0 +1,121 @@
+import json
+import numpy as np
+
+
+def read_mgf_arrays(mgf_path):
+    """
+    Parses a text MGF file once into CSR-style arrays.
+
+    Args:
+        mgf_path (str): Path to the input MGF file.
+
+    Returns:
+        tuple: (mz_concat, int_concat, indptr, meta_list). Peaks of spectrum k are
+        mz_concat[indptr[k]:indptr[k + 1]]; meta_list[k] maps header keys
+        (e.g. 'PEPMASS', 'TITLE') to their raw string values.
+    """
+    mz_values, int_values = [], []
+    indptr, meta_list = [0], []
+    meta = None
+
+    with open(mgf_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            if line == 'BEGIN IONS':
+                meta = {}
+            elif line == 'END IONS':
+                if meta is not None:
+                    meta_list.append(meta)
+                    indptr.append(len(mz_values))
+                meta = None
+            elif meta is not None:
+                if '=' in line:
+                    key, value = line.split('=', 1)
+                    meta[key.strip()] = value.strip()
+                else:
+                    # Peak data (m/z intensity [additional columns])
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        try:
+                            mz, intensity = float(parts[0]), float(parts[1])
+                        except ValueError:
+                            continue
+                        mz_values.append(mz)
+                        int_values.append(intensity)
+
+    return (np.array(mz_values, dtype=np.float64), np.array(int_values, dtype=np.float64),
+            np.array(indptr, dtype=np.int64), meta_list)
+
+
+def write_mgf_arrays(mgf_path, mz_concat, int_concat, indptr, meta_list, peak_format="%s %s"):
+    """
+    Writes CSR-style spectrum arrays back to a text MGF file, one peak_format % (m/z, intensity)
+    line per peak.
+    """
+    with open(mgf_path, 'w', encoding='utf-8') as f:
+        for k, meta in enumerate(meta_list):
+            f.write("BEGIN IONS\n")
+            for key, value in meta.items():
+                f.write(f"{key}={value}\n")
+            for m, i in zip(mz_concat[indptr[k]:indptr[k + 1]].tolist(), int_concat[indptr[k]:indptr[k + 1]].tolist()):
+                f.write(peak_format % (m, i) + "\n")
+            f.write("END IONS\n\n")
+
+
+def save_mgf_npz(path, mz_concat, int_concat, indptr, meta_list):
+    """
+    Saves CSR-style spectrum arrays and their metadata to a binary .npz file.
+
+    Args:
+        path (str): Output path (numpy appends '.npz' if missing).
+        mz_concat (np.ndarray): Concatenated m/z values of all spectra.
+        int_concat (np.ndarray): Concatenated intensities of all spectra.
+        indptr (np.ndarray): Row pointers, length n_spectra + 1.
+        meta_list (list): One header dict per spectrum.
+    """
+    np.savez(path, mz=np.asarray(mz_concat, dtype=np.float64), intensity=np.asarray(int_concat, dtype=np.float64),
+             indptr=np.asarray(indptr, dtype=np.int64), metadata=np.array(json.dumps(meta_list)))
+
+
+def load_mgf_npz(path):
+    """
+    Loads spectrum arrays saved by save_mgf_npz.
+
+    Returns:
+        tuple: (mz_concat, int_concat, indptr, meta_list).
+    """
+    with np.load(path) as data:
+        return data['mz'], data['intensity'], data['indptr'], json.loads(str(data['metadata']))
+
+
+def export_npz_to_mgf(npz_path, mgf_path, peak_format="%s %s"):
+    """
+    Writes a binary stage cache (.npz) back out as a text MGF file (see write_mgf_arrays).
+    """
+    write_mgf_arrays(mgf_path, *load_mgf_npz(npz_path), peak_format=peak_format)
+
+
+def take_rows(mz_concat, int_concat, indptr, rows):
+    """
+    Returns the CSR arrays restricted to the given spectrum rows, in the given order.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    lengths = indptr[rows + 1] - indptr[rows]
+    new_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_indptr[1:])
+    # Position of every kept peak in the original flat arrays
+    positions = np.repeat(indptr[rows] - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return mz_concat[positions], int_concat[positions], new_indptr
+
+
+def mask_peaks(mz_concat, int_concat, indptr, peak_mask):
+    """
+    Returns the CSR arrays keeping only peaks where peak_mask is True (rows may become empty).
+    """
+    row_ids = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    new_indptr = np.zeros_like(indptr)
+    np.cumsum(np.bincount(row_ids[peak_mask], minlength=len(indptr) - 1), out=new_indptr[1:])
+    return mz_concat[peak_mask], int_concat[peak_mask], new_indptr
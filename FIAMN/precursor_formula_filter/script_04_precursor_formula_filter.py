@@ -1,4 +1,74 @@
+import mmap
 import os
+import re
+import numpy as np
+from numba import njit, prange
+
+# Exact atomic masses
+MASS_C = 12.000000
+MASS_H = 1.007825
+MASS_O = 15.994915
+MASS_PROTON = 1.007276  # Mass of H+
+MASS_NA = 22.989218      # Mass of Na+
+
+TOLERANCE = 0.005
+C_MIN, C_MAX = 18, 25  # Carbon count range, inclusive
+
+PEPMASS_PATTERN = re.compile(rb'^PEPMASS=([\d.]+)', re.MULTILINE)
+# One ion block, through the end of its END IONS line (an unterminated trailing ion never matches)
+ION_BLOCK_PATTERN = re.compile(rb'BEGIN IONS.*?END IONS[^\n]*\n?', re.DOTALL)
+PEPMASS_VALUE_PATTERN = re.compile(r'[\d.]+')
+
+
+@njit
+def _cho_match(pepmass):
+    """
+    Returns True if the precursor m/z can be explained by a CHO formula with an even H count.
+    """
+    if not pepmass > 0:
+        return False
+
+    # Iterate through possible ionization adducts
+    for adduct_mass in (MASS_PROTON, MASS_NA):
+        neutral_mass = pepmass - adduct_mass
+        if neutral_mass <= 0:
+            continue
+
+        # Iterate through carbon range
+        for c in range(C_MIN, C_MAX + 1):
+            c_mass = c * MASS_C
+            if c_mass > neutral_mass + TOLERANCE:
+                continue
+
+            # Iterate through possible oxygen counts
+            max_o = int((neutral_mass - c_mass + TOLERANCE) / MASS_O)
+            for o in range(0, max_o + 1):
+                rem_h_mass = neutral_mass - (c_mass + o * MASS_O)
+
+                # Calculate required H count (rounded)
+                h = round(rem_h_mass / MASS_H)
+
+                # --- Core Validation Logic ---
+                # 1. H count must be non-negative
+                # 2. Nitrogen Rule: Neutral CHO molecules must have an even number of hydrogens
+                # 3. Valence Limit: H cannot exceed (2C + 2) (saturated alkane limit)
+                if h >= 0 and h % 2 == 0 and h <= (2 * c + 2):
+                    calc_mass = c_mass + h * MASS_H + o * MASS_O
+                    if abs(calc_mass - neutral_mass) <= TOLERANCE:
+                        return True
+    return False
+
+
+@njit(parallel=True)
+def _cho_match_batch(pepmasses):
+    """
+    Applies _cho_match to every precursor m/z in parallel (NaN marks a missing PEPMASS).
+    """
+    matches = np.zeros(len(pepmasses), dtype=np.bool_)
+    for k in prange(len(pepmasses)):
+        matches[k] = _cho_match(pepmasses[k])
+    return matches
+
 
 def filter_mgf_with_nitrogen_rule(input_file, output_file):
     """
@@ -9,82 +79,80 @@ def filter_mgf_with_nitrogen_rule(input_file, output_file):
     4. Ionization forms: [M+H]+ or [M+Na]+.
     5. Nitrogen Rule: For pure CHO neutral molecules, the number of H must be even.
     """
-    # Exact atomic masses
-    MASS_C = 12.000000
-    MASS_H = 1.007825
-    MASS_O = 15.994915
-    MASS_PROTON = 1.007276  # Mass of H+
-    MASS_NA = 22.989218      # Mass of Na+
+    match_count = 0
 
-    TOLERANCE = 0.005
-    C_RANGE = range(18, 26)  # 18 to 25 inclusive
+    if not os.path.exists(input_file):
+        print(f"Error: File '{input_file}' not found.")
+        return
 
-    match_count = 0
+    print(f"Processing: {input_file}...")
 
-    def is_valid_cho_formula(pepmass):
-        # Iterate through possible ionization adducts
-        for adduct_mass in [MASS_PROTON, MASS_NA]:
-            neutral_mass = pepmass - adduct_mass
-            if neutral_mass <= 0:
-                continue
+    if os.path.getsize(input_file) == 0:
+        # mmap cannot map an empty file
+        open(output_file, 'wb').close()
+    else:
+        with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Pass 1: a single regex scan locates every ion block and its precursor mass without copying lines
+            blocks, pepmasses = [], []
+            for block in ION_BLOCK_PATTERN.finditer(mm):
+                pepmass = np.nan
+                match = PEPMASS_PATTERN.search(mm, block.start(), block.end())
+                if match:
+                    try:
+                        # Extract precursor mass
+                        pepmass = float(match.group(1))
+                    except ValueError:
+                        pass
+
+                blocks.append(block.span())
+                pepmasses.append(pepmass)
+
+            # Pass 2: evaluate all precursors at once and copy the matching ions verbatim
+            keep = _cho_match_batch(np.array(pepmasses, dtype=np.float64))
+            with open(output_file, 'wb') as out:
+                for (start, end), keep_ion in zip(blocks, keep):
+                    if keep_ion:
+                        out.write(mm[start:end])
+                        out.write(b'\n')
+                        match_count += 1
 
-            # Iterate through carbon range
-            for c in C_RANGE:
-                c_mass = c * MASS_C
-                if c_mass > neutral_mass + TOLERANCE:
-                    continue
-
-                # Iterate through possible oxygen counts
-                max_o = int((neutral_mass - c_mass + TOLERANCE) / MASS_O)
-                for o in range(0, max_o + 1):
-                    rem_h_mass = neutral_mass - (c_mass + o * MASS_O)
-
-                    # Calculate required H count (rounded)
-                    h = round(rem_h_mass / MASS_H)
-
-                    # --- Core Validation Logic ---
-                    # 1. H count must be non-negative
-                    # 2. Nitrogen Rule: Neutral CHO molecules must have an even number of hydrogens
-                    # 3. Valence Limit: H cannot exceed (2C + 2) (saturated alkane limit)
-                    if h >= 0 and h % 2 == 0 and h <= (2 * c + 2):
-                        calc_mass = c_mass + h * MASS_H + o * MASS_O
-                        if abs(calc_mass - neutral_mass) <= TOLERANCE:
-                            return True
-        return False
+    print("-" * 30)
+    print(f"Processing Complete!")
+    print(f"Spectra matching CHO rules (even H): {match_count}")
+    print(f"Filtered results saved to: {output_file}")
+    print("-" * 30)
+
+
+def filter_npz_with_nitrogen_rule(input_file, output_file):
+    """
+    Same filter as filter_mgf_with_nitrogen_rule, on the binary stage cache (.npz).
+    """
+    # Imported here so this script still runs standalone from its own directory
+    from mgf_binary_cache.mgf_binary import load_mgf_npz, save_mgf_npz, take_rows
 
     if not os.path.exists(input_file):
         print(f"Error: File '{input_file}' not found.")
         return
 
     print(f"Processing: {input_file}...")
+    mz_concat, int_concat, indptr, meta_list = load_mgf_npz(input_file)
 
-    with open(input_file, 'r') as f, open(output_file, 'w') as out:
-        current_ion = []
-        keep_ion = False
-
-        for line in f:
-            current_ion.append(line)
-            if line.startswith('PEPMASS='):
-                try:
-                    # Extract precursor mass
-                    mz = float(line.split('=')[1].strip())
-                    if is_valid_cho_formula(mz):
-                        keep_ion = True
-                except (ValueError, IndexError):
-                    pass
-
-            if line.strip() == 'END IONS':
-                if keep_ion:
-                    out.writelines(current_ion)
-                    match_count += 1
-
-                # Reset state for next ion
-                current_ion = []
-                keep_ion = False
+    pepmasses = np.full(len(meta_list), np.nan)
+    for k, meta in enumerate(meta_list):
+        match = PEPMASS_VALUE_PATTERN.match(meta.get('PEPMASS', ''))
+        if match:
+            try:
+                # Extract precursor mass
+                pepmasses[k] = float(match.group(0))
+            except ValueError:
+                pass
+
+    rows = np.flatnonzero(_cho_match_batch(pepmasses))
+    save_mgf_npz(output_file, *take_rows(mz_concat, int_concat, indptr, rows), [meta_list[k] for k in rows])
 
     print("-" * 30)
     print(f"Processing Complete!")
-    print(f"Spectra matching CHO rules (even H): {match_count}")
+    print(f"Spectra matching CHO rules (even H): {len(rows)}")
     print(f"Filtered results saved to: {output_file}")
     print("-" * 30)
 
@@ -1,4 +1,5 @@
-import re
+import numpy as np
+from numba import njit, prange
 from typing import List, Tuple, Dict
 
 # Define exact atomic masses (Unit: Da)
@@ -22,22 +23,23 @@ def calculate_ch_mass(c_count: int, h_count: int) -> float:
     return c_count * ATOMIC_MASSES['C'] + h_count * ATOMIC_MASSES['H']
 
 
-def generate_ch_formulas(max_c: int = 50, max_h: int = 100) -> Dict[float, str]:
+def generate_ch_formulas(max_c: int = 50, max_h: int = 100) -> Tuple[np.ndarray, np.ndarray]:
     """
     Pre-generates formulas for C/H combinations and their theoretical masses.
     :param max_c: Maximum number of Carbon atoms
     :param max_h: Maximum number of Hydrogen atoms
-    :return: Dictionary where key is theoretical mass and value is the formula string
+    :return: Tuple of (theoretical masses sorted ascending, matching formula strings)
     """
-    ch_mass_formula = {}
-    for c in range(1, max_c + 1):
-        # Reasonable range for Hydrogen: from CnH(2n+2) (alkanes) to CnH (alkynes/radicals)
-        min_h = max(1, c)  # At least 1 Hydrogen
-        max_h_for_c = 2 * c + 2  # Maximum H for a saturated hydrocarbon
-        for h in range(min_h, min(max_h_for_c + 1, max_h + 1)):
-            mass = calculate_ch_mass(c, h)
-            ch_mass_formula[mass] = f"C{c}H{h}"
-    return ch_mass_formula
+    c_grid, h_grid = np.meshgrid(np.arange(1, max_c + 1), np.arange(1, max_h + 1), indexing='ij')
+    # Reasonable range for Hydrogen: from CnH(2n+2) (alkanes) to CnHn (alkynes/radicals)
+    valid = (h_grid >= c_grid) & (h_grid <= 2 * c_grid + 2)
+    c_counts, h_counts = c_grid[valid], h_grid[valid]
+
+    masses = calculate_ch_mass(c_counts, h_counts)
+    formulas = np.char.add(np.char.add('C', c_counts.astype(str)), np.char.add('H', h_counts.astype(str)))
+
+    order = np.argsort(masses, kind='stable')
+    return masses[order], formulas[order]
 
 
 def parse_mgf(file_path: str) -> List[Dict]:
@@ -75,43 +77,61 @@ def parse_mgf(file_path: str) -> List[Dict]:
                 key, value = line.split('=', 1)
                 current_entry[key.strip()] = value.strip()
             # Peak data (m/z intensity)
-            elif current_entry is not None and re.match(r'^\d+\.?\d*\s+\d+\.?\d*$', line):
-                mz_str, intensity_str = line.split()
+            elif current_entry is not None:
                 try:
-                    mz = float(mz_str)
-                    intensity = float(intensity_str)
-                    peaks_data.append((mz, intensity))
+                    mz, intensity = map(float, line.split())
                 except ValueError:
                     # Skip malformed peak data
                     continue
+                peaks_data.append((mz, intensity))
 
     return mgf_entries
 
 
-def filter_ch_peaks(mgf_entries: List[Dict], ch_mass_formula: Dict[float, str]) -> List[Dict]:
+@njit(parallel=True)
+def _match_ch_masses_kernel(mzs, theory_masses, tolerance):
+    """
+    Parallel per-peak binary search against the sorted theoretical C/H masses.
+    """
+    matched = np.zeros(len(mzs), dtype=np.bool_)
+    for k in prange(len(mzs)):
+        # The closest theoretical masses are the neighbours at the insertion point
+        idx = np.searchsorted(theory_masses, mzs[k])
+        if idx < len(theory_masses) and abs(theory_masses[idx] - mzs[k]) <= tolerance:
+            matched[k] = True
+        elif idx > 0 and abs(theory_masses[idx - 1] - mzs[k]) <= tolerance:
+            matched[k] = True
+    return matched
+
+
+def match_ch_masses(mzs: np.ndarray, theory_masses: np.ndarray) -> np.ndarray:
+    """
+    Flags the m/z values that lie within MASS_TOLERANCE of a theoretical C/H mass.
+    :param mzs: Array of fragment m/z values
+    :param theory_masses: Sorted array of theoretical C/H formula masses
+    :return: Boolean mask, True for matching m/z values
+    """
+    return _match_ch_masses_kernel(np.asarray(mzs, dtype=np.float64),
+                                   np.asarray(theory_masses, dtype=np.float64), MASS_TOLERANCE)
+
+
+def filter_ch_peaks(mgf_entries: List[Dict], theory_masses: np.ndarray) -> List[Dict]:
     """
     Filters fragment peaks to keep only those matching C/H formulas.
     :param mgf_entries: Parsed original MGF entries
-    :param ch_mass_formula: Dictionary of C/H formulas and their masses
+    :param theory_masses: Sorted array of theoretical C/H formula masses
     :return: Filtered MGF entries
     """
     filtered_entries = []
 
-    for entry in mgf_entries:
-        filtered_peaks = []
-        # Iterate through each peak in the entry
-        for mz, intensity in entry['peaks']:
-            # Match against C/H formulas within mass tolerance
-            matched = False
-            for theory_mass, formula in ch_mass_formula.items():
-                if abs(mz - theory_mass) <= MASS_TOLERANCE:
-                    # Optional: Store the matched formula info if needed
-                    # filtered_peaks.append((mz, intensity, formula))
-                    matched = True
-                    break  # Stop searching once a match is found
-
-            if matched:
-                filtered_peaks.append((mz, intensity))
+    # Match the fragments of all entries at once against C/H formulas within mass tolerance
+    lengths = np.array([len(entry['peaks']) for entry in mgf_entries], dtype=np.int64)
+    mzs = np.fromiter((peak[0] for entry in mgf_entries for peak in entry['peaks']),
+                      dtype=np.float64, count=int(lengths.sum()))
+    matched = match_ch_masses(mzs, theory_masses)
+
+    for entry, entry_matched in zip(mgf_entries, np.split(matched, np.cumsum(lengths)[:-1])):
+        filtered_peaks = [entry['peaks'][i] for i in np.flatnonzero(entry_matched)]
 
         # Only keep entries that still have valid peaks after filtering
         if filtered_peaks:
@@ -130,17 +150,14 @@ def write_mgf(file_path: str, filtered_entries: List[Dict]):
     """
     with open(file_path, 'w', encoding='utf-8') as f:
         for entry in filtered_entries:
-            f.write("BEGIN IONS\n")
-            # Write metadata
-            for key, value in entry.items():
-                if key != 'peaks':
-                    f.write(f"{key}={value}\n")
-            # Write peak data (m/z and intensity only)
-            for peak in entry['peaks']:
-                if isinstance(peak, tuple):
-                    mz, intensity = peak[:2]
-                    f.write(f"{mz:.6f} {intensity:.2f}\n")
-            f.write("END IONS\n\n")
+            # Metadata lines
+            lines = ["BEGIN IONS\n"]
+            lines.extend(f"{key}={value}\n" for key, value in entry.items() if key != 'peaks')
+            # Peak data (m/z and intensity only), formatted in one pass
+            lines.extend("%.6f %.2f\n" % peak[:2] for peak in entry['peaks'] if isinstance(peak, tuple))
+            lines.append("END IONS\n\n")
+            # One write per entry
+            f.write("".join(lines))
 
 
 def main(input_mgf: str, output_mgf: str):
@@ -151,7 +168,7 @@ def main(input_mgf: str, output_mgf: str):
     """
     # 1. Pre-generate C/H formula-mass library
     print("Generating C/H formula mass library...")
-    ch_mass_formula = generate_ch_formulas(max_c=50, max_h=100)
+    theory_masses, _ = generate_ch_formulas(max_c=50, max_h=100)
 
     # 2. Parse input MGF file
     print(f"Parsing input file: {input_mgf}")
@@ -162,7 +179,7 @@ def main(input_mgf: str, output_mgf: str):
 
     # 3. Filter for C/H fragment peaks
     print("Filtering for C/H fragment peaks...")
-    filtered_entries = filter_ch_peaks(mgf_entries, ch_mass_formula)
+    filtered_entries = filter_ch_peaks(mgf_entries, theory_masses)
 
     # 4. Write output MGF file
     print(f"Writing to output file: {output_mgf}")
@@ -171,6 +188,34 @@ def main(input_mgf: str, output_mgf: str):
     print(f"Processing complete! Filtered {len(filtered_entries)} valid spectral entries.")
 
 
+def main_npz(input_npz: str, output_npz: str):
+    """
+    Same C/H fragment filter as main, reading and writing the binary stage cache (.npz).
+    :param input_npz: Path to input .npz file
+    :param output_npz: Path to output .npz file
+    """
+    # Imported here so this script still runs standalone from its own directory
+    from mgf_binary_cache.mgf_binary import load_mgf_npz, save_mgf_npz, mask_peaks, take_rows
+
+    print("Generating C/H formula mass library...")
+    theory_masses, _ = generate_ch_formulas(max_c=50, max_h=100)
+
+    print(f"Loading input file: {input_npz}")
+    mz_concat, int_concat, indptr, meta_list = load_mgf_npz(input_npz)
+
+    # Match every fragment of every spectrum in one vectorized call
+    print("Filtering for C/H fragment peaks...")
+    mz_concat, int_concat, indptr = mask_peaks(mz_concat, int_concat, indptr, match_ch_masses(mz_concat, theory_masses))
+    rows = np.flatnonzero(np.diff(indptr) > 0)
+    mz_concat, int_concat, indptr = take_rows(mz_concat, int_concat, indptr, rows)
+
+    # Round like write_mgf ("%.6f %.2f") so downstream results match the text pipeline
+    print(f"Writing to output file: {output_npz}")
+    save_mgf_npz(output_npz, np.round(mz_concat, 6), np.round(int_concat, 2), indptr, [meta_list[k] for k in rows])
+
+    print(f"Processing complete! Filtered {len(rows)} valid spectral entries.")
+
+
 if __name__ == "__main__":
     # Please modify the following input and output file paths
     INPUT_MGF_PATH = "precursor_formula_filter.mgf"   # Input path
@@ -1,51 +1,79 @@
 import re
 import math
 import numpy as np
-from typing import List, Dict, Tuple
-from itertools import combinations
+from numba import njit, prange
+from scipy import sparse
+from typing import List, Dict, Optional, Tuple
 
 # ===================== Core Configuration =====================
 SIM_THRESHOLD = 0.9  # Cosine similarity threshold
 MZ_TOLERANCE_DA = 0.01  # Mass tolerance (Da)
 ENTROPY_RATIO_LIMIT = 0.75  # Spectral entropy ratio threshold; values below this set line to dashed
+# Default similarity: 'greedy' (tolerance-window peak matching), 'binned' (shared MZ_TOLERANCE_DA grid)
+# or 'ann' (binned vectors, candidate pairs from an HNSW index; needs the optional hnswlib package)
+SIMILARITY_METHOD = 'greedy'
+ANN_NEIGHBORS = 50  # Nearest neighbours queried per spectrum for method='ann'
+ANN_INDEX_DIM = 256  # Dimension the binned vectors are hashed down to for the HNSW index
+# Prune 'binned' pairs with a CUDA matmul (needs the optional torch package); falls back to the CPU
+USE_GPU = False
+GPU_HALF_PRECISION = False  # Score the GPU tiles in float16 (half the memory traffic; final scores stay float64)
+GPU_TILE_MB = 256  # Device memory per dense GPU tile; sets how many spectra a tile holds for the bin vocabulary
+# Only spectra whose PEPMASS differ by at most this many Da are compared; None compares every pair
+PRECURSOR_DELTA_DA = None
 
+# A peak line holds exactly two non-negative numbers: m/z and intensity (checked only for malformed spectra)
+PEAK_LINE_PATTERN = re.compile(r'^\d+\.?\d*\s+\d+\.?\d*$')
 
-def calculate_spectral_entropy(peaks_dict: Dict[float, float]) -> float:
+XGMML_WRITE_BATCH = 4096  # Nodes/edges formatted in memory per write call
+
+
+def calculate_spectral_entropy(intensity: np.ndarray) -> float:
     """Calculates the Spectral Entropy of a single spectrum."""
-    intensities = np.array(list(peaks_dict.values()))
     # Remove anomalies with intensity <= 0
-    p = intensities[intensities > 0]
+    p = intensity[intensity > 0]
     if len(p) <= 1:
         return 0.0
     # Normalize intensity distribution
-    prob = p / np.sum(p)
-    # Shannon entropy formula
-    return -np.sum(prob * np.log(prob + 1e-12))
+    p = p / p.sum()
+    # Shannon entropy formula; einsum skips the p * log(p) temporary
+    return float(-np.einsum('i,i->', p, np.log(p + 1e-12)))
+
+
+def _parse_peak_block(peak_lines: List[str]) -> np.ndarray:
+    """
+    Parses a spectrum's digit-led peak lines in one np.fromstring call into an (n, 2) array.
+    If any line is not a plain m/z, intensity pair, only lines matching PEAK_LINE_PATTERN are kept.
+    """
+    try:
+        values = np.fromstring(' '.join(peak_lines), sep=' ')
+    except ValueError:
+        values = None
+    if values is None or values.size != 2 * len(peak_lines):
+        values = np.fromstring(' '.join(line for line in peak_lines if PEAK_LINE_PATTERN.match(line)), sep=' ')
+    return values.reshape(-1, 2)
 
 
 def parse_mgf(file_path: str) -> List[Dict]:
-    """Parses an MGF file and extracts spectral data."""
+    """Parses an MGF file and extracts spectral data (peaks as an (n, 2) array of m/z, intensity)."""
     mgf_entries = []
-    current_entry, peaks = None, []
+    current_entry, peak_lines = None, []
     with open(file_path, 'r', encoding='utf-8') as f:
         for line in f:
             line = line.strip()
             if not line: continue
             if line.startswith('BEGIN IONS'):
-                current_entry, peaks = {}, []
+                current_entry, peak_lines = {}, []
             elif line.startswith('END IONS'):
-                if current_entry is not None and peaks:
-                    current_entry['peaks'] = peaks
-                    mgf_entries.append(current_entry)
+                if current_entry is not None and peak_lines:
+                    current_entry['peaks'] = _parse_peak_block(peak_lines)
+                    if len(current_entry['peaks']):
+                        mgf_entries.append(current_entry)
+                current_entry = None
             elif '=' in line and current_entry is not None:
                 key, value = line.split('=', 1)
                 current_entry[key.strip()] = value.strip()
-            elif current_entry is not None and re.match(r'^\d+\.?\d*\s+\d+\.?\d*$', line):
-                try:
-                    mz, intensity = map(float, line.split())
-                    peaks.append((mz, intensity))
-                except ValueError:
-                    continue
+            elif current_entry is not None and line[:1].isdigit():
+                peak_lines.append(line)
     return mgf_entries
 
 
@@ -56,79 +84,378 @@ def generate_spectrum_id(entry: Dict) -> str:
     return f"{round(float(pepmass), 2):.2f}-{int(round(float(rt)))}"
 
 
-def cosine_similarity(peaks1: Dict[float, float], peaks2: Dict[float, float]) -> float:
-    """Calculates the basic cosine similarity between two peak lists."""
-    keys1, keys2 = list(peaks1.keys()), list(peaks2.keys())
-    dot_product, matched = 0.0, set()
-    for mz1, int1 in peaks1.items():
-        for idx2, mz2 in enumerate(keys2):
-            if idx2 not in matched and abs(mz1 - mz2) <= MZ_TOLERANCE_DA:
-                dot_product += int1 * peaks2[mz2]
-                matched.add(idx2)
-                break
-    n1 = math.sqrt(sum(i ** 2 for i in peaks1.values()))
-    n2 = math.sqrt(sum(i ** 2 for i in peaks2.values()))
-    return dot_product / (n1 * n2) if n1 and n2 else 0.0
+@njit
+def cosine_similarity(mz1: np.ndarray, int1: np.ndarray, mz2: np.ndarray, int2: np.ndarray, tolerance: float) -> float:
+    """
+    Calculates the basic cosine similarity between two m/z-sorted peak lists via a two-pointer merge.
+    Intensities must be L2-normalized (see build_similarity_network), so the matched dot product is the cosine.
+    """
+    dot_product = 0.0
+    i, j = 0, 0
+    while i < len(mz1) and j < len(mz2):
+        if mz1[i] - mz2[j] > tolerance:
+            j += 1
+        elif mz2[j] - mz1[i] > tolerance:
+            i += 1
+        else:
+            # Each peak is matched at most once, to the lowest unmatched m/z within tolerance
+            dot_product += int1[i] * int2[j]
+            i += 1
+            j += 1
+    return dot_product
+
+
+@njit(parallel=True)
+def _cosine_rows(mz_flat, int_flat, offsets, stops, row_start, row_stop, tolerance):
+    """
+    Scores spectra [row_start, row_stop) against the spectra j with i < j < stops[i].
+    Column c holds spectrum row_start + c; cells outside that range stay -inf.
+    """
+    scores = np.full((row_stop - row_start, stops[row_start:row_stop].max() - row_start), -np.inf)
+    for r in prange(row_stop - row_start):
+        i = row_start + r
+        for j in range(i + 1, stops[i]):
+            scores[r, j - row_start] = cosine_similarity(mz_flat[offsets[i]:offsets[i + 1]], int_flat[offsets[i]:offsets[i + 1]],
+                                             mz_flat[offsets[j]:offsets[j + 1]], int_flat[offsets[j]:offsets[j + 1]],
+                                             tolerance)
+    return scores
+
+
+def pairwise_cosine_pairs(mz_flat: np.ndarray, int_flat: np.ndarray, offsets: np.ndarray, threshold: float,
+                          stops: Optional[np.ndarray] = None,
+                          block: int = 256) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (i, j, similarity) for all pairs i < j with cosine_similarity >= threshold, in parallel row blocks.
+    If stops is given, spectrum i is only compared with spectra j < stops[i].
+    """
+    n = len(offsets) - 1
+    stops = np.full(n, n, dtype=np.int64) if stops is None else np.asarray(stops, dtype=np.int64)
+    rows, cols, sims = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for start in range(0, n, block):
+        scores = _cosine_rows(mz_flat, int_flat, offsets, stops, start, min(start + block, n), MZ_TOLERANCE_DA)
+        r, c = np.nonzero(scores >= threshold)
+        rows.append(r + start)
+        cols.append(c + start)
+        sims.append(scores[r, c])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
+
+
+def binned_spectrum_matrix(mz_flat: np.ndarray, int_flat: np.ndarray, offsets: np.ndarray,
+                           bin_width: float = MZ_TOLERANCE_DA) -> sparse.csr_matrix:
+    """Bins all spectra onto one shared m/z grid; returns L2-normalized rows (N_spectra x N_bins)."""
+    n = len(offsets) - 1
+    rows = np.repeat(np.arange(n), np.diff(offsets))
+
+    # Global bin vocabulary: one column per occupied bin, peaks sharing a bin are summed
+    vocab, cols = np.unique(np.round(mz_flat / bin_width).astype(np.int64), return_inverse=True)
+    X = sparse.csr_matrix((int_flat, (rows, cols)), shape=(n, len(vocab)))
+
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.diags(scale) @ X
+
+
+def pairwise_above_threshold(X: sparse.csr_matrix, threshold: float, stops: Optional[np.ndarray] = None,
+                             block: int = 1024) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (i, j, similarity) for all pairs i < j with S = X @ X.T >= threshold, sorted by (i, j).
+    S is computed in block x block tiles, so the N x N product never exists at once.
+    If stops is given, spectrum i is only compared with spectra j < stops[i].
+    """
+    n = X.shape[0]
+    rows, cols, sims = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for i0 in range(0, n, block):
+        X_rows = X[i0:i0 + block]
+        col_stop = n if stops is None else stops[i0:i0 + block].max()
+        # Tiles left of the diagonal hold only pairs j <= i
+        for j0 in range(i0, col_stop, block):
+            S = (X_rows @ X[j0:j0 + block].T).tocoo()
+            r, c = S.row.astype(np.int64) + i0, S.col.astype(np.int64) + j0
+            keep = (S.data >= threshold) & (c > r)
+            if stops is not None:
+                keep &= c < stops[r]
+            rows.append(r[keep])
+            cols.append(c[keep])
+            sims.append(S.data[keep])
+    rows, cols, sims = np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order], sims[order]
+
+
+def ann_similarity_pairs(X: sparse.csr_matrix, threshold: float,
+                         k: int = ANN_NEIGHBORS) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (i, j, similarity) for pairs i < j with S >= threshold among the k approximate nearest
+    neighbours of each spectrum (hnswlib inner-product index over the binned rows, hashed down to
+    ANN_INDEX_DIM dimensions). Candidates are rescored exactly from X; a pair outside both spectra's
+    k neighbours is not found.
+    """
+    try:
+        import hnswlib
+    except ImportError as e:
+        raise ImportError("method='ann' requires hnswlib (pip install hnswlib).") from e
+
+    n, dim = X.shape
+    k = min(k, n)
+    if n < 2 or dim == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    vectors = _hashed_index_vectors(X, ANN_INDEX_DIM)
+    index = hnswlib.Index(space='ip', dim=vectors.shape[1])
+    index.init_index(max_elements=n, ef_construction=200, M=16)
+    index.add_items(vectors, np.arange(n))
+    index.set_ef(max(2 * k, 64))
+    labels, _ = index.knn_query(vectors, k=k)
+
+    # Each unordered pair once, sorted by (i, j)
+    first = np.repeat(np.arange(n, dtype=np.int64), k)
+    second = labels.ravel().astype(np.int64)
+    keys = np.unique(np.minimum(first, second) * n + np.maximum(first, second))
+    rows, cols = keys // n, keys % n
+    distinct = rows != cols
+    rows, cols = rows[distinct], cols[distinct]
+
+    return _rescore_pairs(X, rows, cols, threshold)
+
+
+def _hashed_index_vectors(X: sparse.csr_matrix, dim: int, seed: int = 0) -> np.ndarray:
+    """
+    Dense float32 index vectors for X with at most dim columns. Wider bin vocabularies (the
+    MZ_TOLERANCE_DA grid has one column per occupied 0.01 Da bin) are reduced by signed feature
+    hashing, which keeps inner products in expectation; rows are re-normalized afterwards.
+    """
+    n_bins = X.shape[1]
+    if n_bins <= dim:
+        return X.toarray().astype(np.float32)
+
+    # Each bin adds its intensity, with a random sign, to one of dim buckets
+    rng = np.random.default_rng(seed)
+    P = sparse.csr_matrix((rng.choice([-1.0, 1.0], n_bins), (np.arange(n_bins), rng.integers(0, dim, n_bins))),
+                          shape=(n_bins, dim))
+    vectors = (X @ P).toarray().astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _cuda_available() -> bool:
+    """Returns True if the optional torch package is installed and sees a CUDA device."""
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+def gpu_pairwise_above_threshold(X: sparse.csr_matrix, threshold: float, stops: Optional[np.ndarray] = None,
+                                 block: Optional[int] = None, half: bool = False,
+                                 margin: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Same pairs as pairwise_above_threshold, with the tiles of X @ X.T multiplied on a CUDA GPU.
+    X is uploaded once as sparse row blocks, which are densified on the device per tile; block
+    defaults to as many spectra (up to 4096) as fit GPU_TILE_MB for the bin vocabulary.
+    Tiles are scored in float32 (float16 if half) against threshold - margin and only select
+    candidates; kept pairs are rescored in float64 from X. margin defaults to 1e-4 (1e-2 if half),
+    above the rounding error of a unit-vector dot product at that precision.
+    """
+    import torch
+
+    tile_dtype = torch.float16 if half else torch.float32
+    if margin is None:
+        margin = 1e-2 if half else 1e-4
+
+    n, n_bins = X.shape
+    if block is None:
+        # At most 4096 rows, so the block x block score tile stays small for narrow vocabularies
+        block = int(np.clip((GPU_TILE_MB << 20) // (max(n_bins, 1) * (2 if half else 4)), 1, 4096))
+
+    def to_gpu(rows):
+        return torch.sparse_csr_tensor(torch.from_numpy(rows.indptr.astype(np.int64)),
+                                       torch.from_numpy(rows.indices.astype(np.int64)),
+                                       torch.from_numpy(rows.data.astype(np.float32)),
+                                       size=rows.shape).to('cuda')
+
+    # Only the nonzeros cross to the device, each row block once
+    tiles = [to_gpu(X[i0:i0 + block]) for i0 in range(0, n, block)]
+    row_parts, col_parts = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for i0 in range(0, n, block):
+        X_rows = tiles[i0 // block].to_dense().to(tile_dtype)
+        col_stop = n if stops is None else stops[i0:i0 + block].max()
+        for j0 in range(i0, col_stop, block):
+            S = X_rows @ tiles[j0 // block].to_dense().to(tile_dtype).T
+            r, c = torch.nonzero(S >= threshold - margin, as_tuple=True)
+            # Only the (i, j) triplets come back to the host
+            r, c = r.cpu().numpy().astype(np.int64) + i0, c.cpu().numpy().astype(np.int64) + j0
+            keep = c > r
+            if stops is not None:
+                keep &= c < stops[r]
+            row_parts.append(r[keep])
+            col_parts.append(c[keep])
+    rows, cols = np.concatenate(row_parts), np.concatenate(col_parts)
+    order = np.lexsort((cols, rows))
+    return _rescore_pairs(X, rows[order], cols[order], threshold)
+
+
+def _rescore_pairs(X: sparse.csr_matrix, rows: np.ndarray, cols: np.ndarray,
+                   threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Scores candidate pairs exactly from the normalized rows of X and keeps those >= threshold."""
+    sims = np.asarray(X[rows].multiply(X[cols]).sum(axis=1)).ravel()
+    keep = sims >= threshold
+    return rows[keep], cols[keep], sims[keep]
 
 
 def save_cytoscape_xgmml(file_path: str, all_nodes: List[Dict], edges: List[Dict]):
     """Generates an XGMML file containing node/edge logic for Cytoscape visualization."""
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        f.write('<graph xmlns="http://www.cs.rpi.edu/XGMML" directed="0" label="Diterpene Entropy Network">\n')
+    with open(file_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        # Elements are formatted as one string each and written in batches of XGMML_WRITE_BATCH
+        chunks = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+                  '<graph xmlns="http://www.cs.rpi.edu/XGMML" directed="0" label="Diterpene Entropy Network">\n']
 
         # Write nodes
         for node in all_nodes:
             label = f"{node['pepmass']:.2f}&#10;{node['retention_time']}"
-            f.write(f'  <node id="{node["id"]}" label="{label}">\n')
-            f.write(f'    <att name="pepmass" type="real" value="{node["pepmass"]}"/>\n')
-            f.write(f'    <att name="rt" type="integer" value="{node["retention_time"]}"/>\n')
-            f.write(f'    <att name="spectral_entropy" type="real" value="{node["entropy"]}"/>\n')
-            f.write('  </node>\n')
+            chunks.append(
+                f'  <node id="{node["id"]}" label="{label}">\n'
+                f'    <att name="pepmass" type="real" value="{node["pepmass"]}"/>\n'
+                f'    <att name="rt" type="integer" value="{node["retention_time"]}"/>\n'
+                f'    <att name="spectral_entropy" type="real" value="{node["entropy"]}"/>\n'
+                '  </node>\n'
+            )
+            if len(chunks) >= XGMML_WRITE_BATCH:
+                f.write(''.join(chunks))
+                chunks.clear()
 
         # Write edges (including dashed line logic)
-        for i, edge in enumerate(edges):
-            f.write(f'  <edge id="{i}" source="{edge["source"]}" target="{edge["target"]}">\n')
-            f.write(f'    <att name="cosine_similarity" type="real" value="{edge["similarity"]}"/>\n')
-            f.write(f'    <att name="entropy_ratio" type="real" value="{edge["entropy_ratio"]}"/>\n')
-            # Set line style based on entropy ratio (Cytoscape attribute)
-            line_style = "dash" if edge["entropy_ratio"] < ENTROPY_RATIO_LIMIT else "solid"
-            f.write(f'    <att name="line_style" type="string" value="{line_style}"/>\n')
-            f.write('  </edge>\n')
-
-        f.write('</graph>\n')
+        # Set line style based on entropy ratio (Cytoscape attribute), for all edges at once
+        ratios = np.fromiter((edge['entropy_ratio'] for edge in edges), dtype=np.float64, count=len(edges))
+        line_styles = np.where(ratios < ENTROPY_RATIO_LIMIT, 'dash', 'solid').tolist()
+        for i, (edge, line_style) in enumerate(zip(edges, line_styles)):
+            chunks.append(
+                f'  <edge id="{i}" source="{edge["source"]}" target="{edge["target"]}">\n'
+                f'    <att name="cosine_similarity" type="real" value="{edge["similarity"]}"/>\n'
+                f'    <att name="entropy_ratio" type="real" value="{edge["entropy_ratio"]}"/>\n'
+                f'    <att name="line_style" type="string" value="{line_style}"/>\n'
+                '  </edge>\n'
+            )
+            if len(chunks) >= XGMML_WRITE_BATCH:
+                f.write(''.join(chunks))
+                chunks.clear()
+
+        chunks.append('</graph>\n')
+        f.write(''.join(chunks))
     print(f"✅ XGMML visualization file saved: {file_path} (Edges: {len(edges)})")
 
 
-def run_similarity_network_pipeline(input_mgf: str, output_xgmml: str):
+def run_similarity_network_pipeline(input_mgf: str, output_xgmml: str, method: Optional[str] = None,
+                                    precursor_delta: Optional[float] = None):
     """
     Main pipeline: Parses spectra, calculates entropy, computes similarity network,
     and exports to XGMML.
+    method='greedy' matches peaks within MZ_TOLERANCE_DA pair by pair; method='binned'
+    sums peaks into a shared MZ_TOLERANCE_DA grid, so no intensity is lost to first-fit
+    matching, and scores all pairs with a tiled sparse matmul. method='ann' scores the same
+    binned vectors but only for ANN_NEIGHBORS approximate neighbours per spectrum, which
+    scales to large collections at the cost of possibly missing edges. None uses SIMILARITY_METHOD.
+    precursor_delta (Da) limits scoring to spectra with close PEPMASS values. None uses
+    PRECURSOR_DELTA_DA; math.inf compares every pair.
     """
     print("🔍 Parsing spectra and calculating spectral entropy...")
-    entries = parse_mgf(input_mgf)
+    build_similarity_network(parse_mgf(input_mgf), output_xgmml, method, precursor_delta)
+
+
+def run_similarity_network_pipeline_npz(input_npz: str, output_xgmml: str, method: Optional[str] = None,
+                                        precursor_delta: Optional[float] = None):
+    """
+    Same pipeline as run_similarity_network_pipeline, reading the binary stage cache (.npz).
+    """
+    # Imported here so this script still runs standalone from its own directory
+    from mgf_binary_cache.mgf_binary import load_mgf_npz
+
+    print("🔍 Loading spectra and calculating spectral entropy...")
+    mz_concat, int_concat, indptr, meta_list = load_mgf_npz(input_npz)
+    entries = [
+        dict(meta, peaks=np.column_stack((mz_concat[lo:hi], int_concat[lo:hi])))
+        for meta, lo, hi in zip(meta_list, indptr[:-1], indptr[1:]) if hi > lo
+    ]
+    build_similarity_network(entries, output_xgmml, method, precursor_delta)
+
+
+def build_similarity_network(entries: List[Dict], output_xgmml: str, method: Optional[str] = None,
+                             precursor_delta: Optional[float] = None):
+    """
+    Calculates entropy and the similarity network for parsed entries and exports to XGMML.
+    """
+    method = SIMILARITY_METHOD if method is None else method
+    if method not in ('greedy', 'binned', 'ann'):
+        raise ValueError("method must be 'greedy', 'binned' or 'ann'.")
+
     processed_data = []
 
     for entry in entries:
         sid = generate_spectrum_id(entry)
-        peaks = {mz: i for mz, i in entry.get('peaks', [])}
-        entropy = calculate_spectral_entropy(peaks)
+        peaks = np.asarray(entry.get('peaks', []), dtype=np.float64).reshape(-1, 2)
+        # m/z-sorted SoA peak arrays; a repeated m/z keeps its last intensity
+        mz, last = np.unique(peaks[::-1, 0], return_index=True)
+        intensity = peaks[::-1, 1][last]
+        entropy = calculate_spectral_entropy(intensity)
+        # L2 norm, computed once per spectrum instead of once per pair
+        norm = math.sqrt(float(np.vdot(intensity, intensity)))
 
         # Extract metadata for node display
         pepmass = float(sid.split('-')[0])
         rt = int(sid.split('-')[1])
 
         processed_data.append({
-            'id': sid, 'peaks': peaks, 'entropy': entropy,
+            'id': sid, 'mz': mz, 'intensity': intensity, 'norm': norm, 'entropy': entropy,
             'pepmass': pepmass, 'retention_time': rt
         })
 
+    delta = PRECURSOR_DELTA_DA if precursor_delta is None else precursor_delta
+    if delta is None:
+        order, stops = np.arange(len(processed_data)), None
+    else:
+        # In PEPMASS order, each spectrum's candidates are the following spectra up to its PEPMASS + delta
+        pepmass = np.array([d['pepmass'] for d in processed_data], dtype=np.float64)
+        order = np.argsort(pepmass, kind='mergesort')
+        stops = np.searchsorted(pepmass[order], pepmass[order] + delta, side='right')
+    ordered = [processed_data[k] for k in order]
+
+    # Flat (SoA) peak arrays, spectrum k of ordered owns [offsets[k], offsets[k + 1])
+    offsets = np.zeros(len(ordered) + 1, dtype=np.int64)
+    np.cumsum([len(d['mz']) for d in ordered], out=offsets[1:])
+    mz_flat = np.concatenate([d['mz'] for d in ordered] + [np.empty(0)])
+    int_flat = np.concatenate([d['intensity'] for d in ordered] + [np.empty(0)])
+
     edges = []
     print(f"📈 Calculating similarity and entropy ratios (Threshold: {SIM_THRESHOLD})...")
-    for (i, d1), (j, d2) in combinations(enumerate(processed_data), 2):
-        cos_sim = cosine_similarity(d1['peaks'], d2['peaks'])
+    if method in ('binned', 'ann'):
+        X = binned_spectrum_matrix(mz_flat, int_flat, offsets)
+        if method == 'ann':
+            rows, cols, sims = ann_similarity_pairs(X, SIM_THRESHOLD)
+            if stops is not None:
+                in_window = cols < stops[rows]
+                rows, cols, sims = rows[in_window], cols[in_window], sims[in_window]
+        elif USE_GPU and _cuda_available():
+            rows, cols, sims = gpu_pairwise_above_threshold(X, SIM_THRESHOLD, stops, half=GPU_HALF_PRECISION)
+        else:
+            if USE_GPU:
+                print("⚠️ USE_GPU is set but torch with CUDA is not available; scoring on the CPU.")
+            rows, cols, sims = pairwise_above_threshold(X, SIM_THRESHOLD, stops)
+    else:
+        # Normalize every spectrum once so the per-pair cosine needs no division
+        norms = np.array([d['norm'] for d in ordered], dtype=np.float64)
+        scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        unit_flat = int_flat * np.repeat(scale, np.diff(offsets))
+        rows, cols, sims = pairwise_cosine_pairs(mz_flat, unit_flat, offsets, SIM_THRESHOLD, stops)
+
+    # Map back to input positions (i < j) and emit edges in the same order as an all-pairs scan
+    rows, cols = order[rows], order[cols]
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    edge_order = np.lexsort((cols, rows))
+    pairs = zip(rows[edge_order].tolist(), cols[edge_order].tolist(), sims[edge_order].tolist())
 
+    for i, j, cos_sim in pairs:
         if cos_sim >= SIM_THRESHOLD:
+            d1, d2 = processed_data[i], processed_data[j]
             # Calculate entropy ratio: min(entropy) / max(entropy)
             e1, e2 = d1['entropy'], d2['entropy']
             if e1 > 0 and e2 > 0:
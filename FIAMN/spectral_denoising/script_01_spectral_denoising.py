@@ -1,11 +1,68 @@
 import numpy as np
-from scipy import stats
 import os
 
 
 import os
 import numpy as np
-from scipy import stats
+
+# The mode is taken with np.bincount only while the rounded intensities span at most this many
+# values per peak; raw intensities (1e5-1e7) would make the count array far larger than the spectrum
+BINCOUNT_RANGE_PER_PEAK = 8
+
+
+def _filter_nonzero_mode(mz_array, intensity_array):
+    """
+    Removes peaks with intensity equal to 0 or not above the most common
+    non-zero intensity value (noise floor) of a single spectrum.
+    """
+    # Pre-filter: Remove peaks with 0 intensity
+    valid_mask = intensity_array > 0
+    mz_v = mz_array[valid_mask]
+    int_v = intensity_array[valid_mask]
+
+    if len(int_v) == 0:
+        return mz_v, int_v
+
+    # Calculate mode of non-zero intensities
+    # (Rounding helps identify the baseline noise level)
+    rounded_int = np.round(int_v)
+    if rounded_int.max() <= BINCOUNT_RANGE_PER_PEAK * len(rounded_int):
+        # Counting sort over the small non-negative integer range (ties resolve to the smallest value)
+        nonzero_mode_val = np.bincount(rounded_int.astype(np.intp)).argmax()
+    else:
+        values, counts = np.unique(rounded_int, return_counts=True)
+        nonzero_mode_val = values[counts.argmax()]
+
+    # Final filter: Intensity must be > the non-zero mode
+    final_mask = int_v > nonzero_mode_val
+    return mz_v[final_mask], int_v[final_mask]
+
+
+def _parse_peak_lines(peak_lines):
+    """
+    Parses the peak lines of one spectrum into (mz_array, intensity_array) with a single call.
+    """
+    try:
+        values = np.fromstring(' '.join(peak_lines), sep=' ')
+    except ValueError:
+        # Recent NumPy raises on text it cannot parse; older versions warn and stop early
+        values = None
+    if values is not None and values.size == 2 * len(peak_lines):
+        values = values.reshape(-1, 2)
+        return values[:, 0], values[:, 1]
+
+    # Fallback for irregular peak lines (extra columns, stray text)
+    spectrum_data = []
+    for line in peak_lines:
+        try:
+            parts = line.split()
+            if len(parts) >= 2:
+                spectrum_data.append((float(parts[0]), float(parts[1])))
+        except ValueError:
+            continue
+    values = np.array(spectrum_data, dtype=np.float64).reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
 
 def filter_mgf_by_nonzero_mode(input_path, output_path):
     """
@@ -18,83 +75,89 @@ def filter_mgf_by_nonzero_mode(input_path, output_path):
 
     print(f"Processing: {input_path} ...")
 
-    with open(input_path, 'r') as f:
-        lines = f.readlines()
-
-    filtered_mgf = []
-    spectrum_data = []
+    peak_lines = []
     in_spectrum = False
     header_info = []
 
     total_ions = 0
     removed_ions = 0
 
-    for line in lines:
-        line = line.strip()
-        if not line: continue
+    # Each spectrum is written as soon as it is finalized, so memory does not grow with the file
+    with open(input_path, 'r') as fin, open(output_path, 'w', buffering=1 << 20) as fout:
+        for line in fin:
+            line = line.strip()
+            if not line: continue
+
+            if line == "BEGIN IONS":
+                in_spectrum = True
+                peak_lines = []
+                header_info = []
+                fout.write("BEGIN IONS\n")
+                continue
+
+            if line == "END IONS":
+                in_spectrum = False
+                # 1. Parse all peak lines into numpy arrays at once
+                mz_array, intensity_array = _parse_peak_lines(peak_lines)
+                if len(intensity_array):
+                    # 2. Remove 0-intensity peaks and peaks at the non-zero mode
+                    final_mz, final_int = _filter_nonzero_mode(mz_array, intensity_array)
+
+                    # Statistics tracking
+                    total_ions += len(intensity_array)
+                    removed_ions += (len(intensity_array) - len(final_int))
+
+                    # 3. Write headers and filtered ions of this spectrum
+                    fout.writelines(f"{header}\n" for header in header_info)
+                    fout.write(''.join([f"{m:.5f} {i:.1f}\n" for m, i in zip(final_mz.tolist(), final_int.tolist())]))
+
+                fout.write("END IONS\n")
+                continue
+
+            if in_spectrum:
+                if "=" in line:
+                    header_info.append(line)
+                else:
+                    peak_lines.append(line)
+            else:
+                fout.write(line + "\n")
 
-        if line == "BEGIN IONS":
-            in_spectrum = True
-            spectrum_data = []
-            header_info = []
-            filtered_mgf.append(line)
-            continue
+    print(f"--- Processing Complete ---")
+    print(f"Output File: {output_path}")
+    print(f"Total Ions: {total_ions}")
+    print(f"Removed Ions (0s and Mode): {removed_ions}")
+    if total_ions > 0:
+        print(f"Removal Rate: {removed_ions / total_ions:.1%}")
 
-        if line == "END IONS":
-            in_spectrum = False
-            if spectrum_data:
-                # 1. Convert to numpy arrays
-                mz_array = np.array([x[0] for x in spectrum_data])
-                intensity_array = np.array([x[1] for x in spectrum_data])
-
-                # 2. Pre-filter: Remove peaks with 0 intensity
-                valid_mask = intensity_array > 0
-                mz_v = mz_array[valid_mask]
-                int_v = intensity_array[valid_mask]
-
-                if len(int_v) > 0:
-                    # 3. Calculate mode of non-zero intensities
-                    # (Rounding helps identify the baseline noise level)
-                    rounded_int = np.round(int_v)
-                    mode_result = stats.mode(rounded_int, keepdims=True)
-                    nonzero_mode_val = mode_result.mode[0]
-
-                    # 4. Final filter: Intensity must be > the non-zero mode
-                    final_mask = int_v > nonzero_mode_val
-                    final_mz = mz_v[final_mask]
-                    final_int = int_v[final_mask]
-                else:
-                    final_mz = []
-                    final_int = []
 
-                # Statistics tracking
-                total_ions += len(intensity_array)
-                removed_ions += (len(intensity_array) - len(final_int))
+def filter_mgf_by_nonzero_mode_npz(input_path, output_path):
+    """
+    Same filter as filter_mgf_by_nonzero_mode, but saves the result to the
+    binary stage cache (.npz) so later pipeline steps skip text parsing.
+    """
+    # Imported here so this script still runs standalone from its own directory
+    from mgf_binary_cache.mgf_binary import read_mgf_arrays, save_mgf_npz
 
-                # 5. Write headers and filtered ions back to list
-                filtered_mgf.extend(header_info)
-                for m, i in zip(final_mz, final_int):
-                    filtered_mgf.append(f"{m:.5f} {i:.1f}")
+    if not os.path.exists(input_path):
+        print(f"Error: Input file '{input_path}' not found.")
+        return
 
-            filtered_mgf.append("END IONS")
-            continue
+    print(f"Processing: {input_path} ...")
+    mz_concat, int_concat, indptr, meta_list = read_mgf_arrays(input_path)
 
-        if in_spectrum:
-            if "=" in line:
-                header_info.append(line)
-            else:
-                try:
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        spectrum_data.append((float(parts[0]), float(parts[1])))
-                except ValueError:
-                    continue
-        else:
-            filtered_mgf.append(line)
-
-    with open(output_path, 'w') as f:
-        f.write("\n".join(filtered_mgf) + "\n")
+    out_mz, out_int, out_indptr = [], [], [0]
+    for lo, hi in zip(indptr[:-1], indptr[1:]):
+        final_mz, final_int = _filter_nonzero_mode(mz_concat[lo:hi], int_concat[lo:hi])
+        # Round like the text writer ("%.5f %.1f") so downstream results match
+        out_mz.append(np.round(final_mz, 5))
+        out_int.append(np.round(final_int, 1))
+        out_indptr.append(out_indptr[-1] + len(final_mz))
+
+    save_mgf_npz(output_path, np.concatenate(out_mz + [np.empty(0)]), np.concatenate(out_int + [np.empty(0)]),
+                 out_indptr, meta_list)
 
+    total_ions = len(int_concat)
+    removed_ions = total_ions - out_indptr[-1]
     print(f"--- Processing Complete ---")
     print(f"Output File: {output_path}")
     print(f"Total Ions: {total_ions}")